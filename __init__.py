@@ -15,8 +15,17 @@
 from os import path
 import os
 import fnmatch
+import functools
+import hashlib
+import io
+import itertools
+import json
+import zlib
 import re
+import shlex
+import subprocess
 import sys
+import time
 import argparse
 
 from . import ninja_syntax
@@ -25,27 +34,351 @@ from .toolchain import llvm
 from .toolchain import ms
 
 # util functions
+_ignored_dirs = ['obj', 'bin', 'dist']
+_ignored_names = ['.git']
+
+def _ignored(dir, name):
+    return name in _ignored_names or path.normpath(dir) in _ignored_dirs
+
+_patterns = {}
+def _pattern(pattern):
+    if pattern not in _patterns:
+        _patterns[pattern] = re.compile(fnmatch.translate(pattern))
+    return _patterns[pattern]
+
+def _list_dir(dir):
+    files = []
+    dirs = []
+    for entry in os.scandir(dir):
+        if not entry.is_dir():
+            files.append(entry.name)
+        elif not entry.is_symlink() and not _ignored(entry.path, entry.name):
+            dirs.append(entry.name)
+    return files, dirs
+
+_racy = 2 * 10**9 # ns; directories modified this close to a scan may change again within the same timestamp
+
+def _scan(root, snapshot={}, listings=None):
+    files = []
+    if not path.isdir(root):
+        return files
+    start = time.time_ns()
+    pending = [root]
+    while pending:
+        dir = pending.pop()
+        try:
+            mtime = os.stat(dir).st_mtime_ns
+        except OSError:
+            continue
+        cached = snapshot.get(dir)
+        if cached and cached[0] == mtime:
+            names, dirs = cached[1], cached[2]
+        else:
+            names, dirs = _list_dir(dir)
+        if listings is not None:
+            # a racily clean listing is not cached, so the next scan lists the directory again
+            listings[dir] = [mtime if mtime < start - _racy else None, names, dirs]
+        files.extend((path.join(dir, f), f) for f in names)
+        pending.extend(path.join(dir, d) for d in dirs)
+    files.sort()
+    return files
+
 def get_files(root, pattern):
-    pattern = fnmatch.translate(pattern)
-    for dir, dirs, files in os.walk(root):
-        for f in files:
-            if re.match(pattern, f):
-                yield path.join(dir, f)
-
-def object_file(src):
-    return path.join('obj', re.sub(r'\.c\+\+$', '.o', src))
-
-def _build_objects(ninja, root):
-    src_files = list(get_files(root, '*.c++'))
-    obj_files = [object_file(fn) for fn in src_files]
-    for fn in src_files:
-        ninja.build(object_file(fn), 'cxx',
-                    inputs = fn)
-    return obj_files
-
-def _target_alias(ninja, alias, output):
-    ninja.build(alias, 'phony',
-                inputs = output)
+    match = _pattern(pattern).match
+    for f, name in _scan(root):
+        if match(name):
+            yield f
+
+def _quote(argument):
+    return subprocess.list2cmdline([argument]) if os.name == 'nt' else shlex.quote(argument)
+
+def _write_if_changed(filename, content):
+    content = content.encode('utf-8')
+    try:
+        with open(filename, 'rb') as f:
+            if hashlib.sha1(f.read()).digest() == hashlib.sha1(content).digest():
+                return False
+    except OSError:
+        pass
+    directory = path.dirname(filename)
+    if directory and not path.isdir(directory):
+        os.makedirs(directory)
+    temp = filename + '.tmp'
+    with open(temp, 'wb') as f:
+        f.write(content)
+    os.replace(temp, filename)
+    return True
+
+class _Stopwatch:
+    def __init__(self):
+        self.laps = {}
+        self._last = time.perf_counter()
+
+    def lap(self, phase):
+        now = time.perf_counter()
+        self.laps[phase] = self.laps.get(phase, 0) + now - self._last
+        self._last = now
+
+class _FileIndex:
+    def __init__(self, cache=None):
+        self._cache = cache
+        self.scan_time = 0
+        self._snapshots = {}
+        self._listings = {}
+        self._roots = {}
+        self._matches = {}
+        if cache:
+            try:
+                with open(cache) as f:
+                    self._snapshots = json.load(f)
+            except (OSError, ValueError):
+                pass
+
+    def files(self, root):
+        if root not in self._roots:
+            start = time.perf_counter()
+            listings = self._listings.setdefault(root, {})
+            self._roots[root] = _scan(root, self._snapshots.get(root, {}), listings)
+            self.scan_time += time.perf_counter() - start
+        return self._roots[root]
+
+    def get(self, root, pattern):
+        key = (root, pattern)
+        if key not in self._matches:
+            match = _pattern(pattern).match
+            self._matches[key] = [f for f, name in self.files(root) if match(name)]
+        return self._matches[key]
+
+    def save(self):
+        if self._cache:
+            _write_if_changed(self._cache, json.dumps(self._listings, sort_keys=True))
+
+def object_file(src, variant=None):
+    if path.normpath(src).startswith('obj' + os.sep):
+        src = path.relpath(src, 'obj')
+    obj = re.sub(r'\.c\+\+$', '.o', src)
+    return path.join('obj', variant, obj) if variant else path.join('obj', obj)
+
+def _variant(flags):
+    return hashlib.sha1(' '.join(flags).encode('utf-8')).hexdigest()[:8] if flags else None
+
+_configurations = {
+    'debug': dict(debug = True),
+    'release': dict(debug = False),
+    'asan': dict(debug = True, sanitizers = ['address']),
+    'ubsan': dict(debug = True, sanitizers = ['undefined']),
+    'tsan': dict(debug = True, sanitizers = ['thread']),
+}
+
+class _Configuration:
+    def __init__(self, name=None, debug=False, sanitizers=[], profile_generate=False):
+        self.name = name
+        self.debug = debug
+        self.sanitizers = sanitizers
+        self.profile_generate = profile_generate
+        self.profile_use = None
+        self.primary = False
+        self.obj = path.join('obj', name) if name else 'obj'
+        self.bin = path.join('bin', name) if name else 'bin'
+
+    def rule(self, rule):
+        return rule + '_' + self.name if self.name else rule
+
+class _ObjectRegistry:
+    def __init__(self, config, generated, separate_pic=False, tools=None, header=None):
+        self._objects = {}
+        self.config = config
+        self.generated = generated
+        self.separate_pic = separate_pic
+        self.tools = tools
+        self.header = header
+        self.precompiled = {}
+        self.order_only = None
+        self.commands = {}
+        self.compile_commands = {}
+
+    def _directory(self, flags, pic):
+        variant = [v for v in [self.config.name, 'pic' if pic else None, _variant(flags)] if v]
+        return path.join('obj', *variant) if variant else 'obj'
+
+    def precompile(self, ninja, flags=(), pic=False):
+        # one PCH per set of flags, because a PCH is only valid for the flags it was built with
+        pic = pic and self.separate_pic
+        key = (flags, pic)
+        if self.header and key not in self.precompiled:
+            # the PCH is built from a stub that includes the header: the header is not the main
+            # file (so #pragma once works) and the stub is the fallback when the PCH cannot be used
+            stub = path.join(self._directory(flags, pic), self.header)
+            _write_if_changed(stub, '#include "%s"\n' % path.relpath(self.header, path.dirname(stub)).replace(os.sep, '/'))
+            if stub not in self.generated:
+                self.generated.append(stub)
+            pch = self.tools.precompiled_header_name(stub)
+            objects = self.tools.precompiled_header_objects(pch)
+            variables = {'pchflags': ' '.join(self.tools.precompiled_header_flags(stub, pch))}
+            if objects:
+                variables['pchobject'] = objects[0]
+            if flags:
+                variables['extraflags'] = ' '.join(flags)
+            ninja.build([pch] + objects, self.config.rule('pch_pic' if pic else 'pch'),
+                        inputs = stub,
+                        implicit = [self.header] + ([self.config.profile_use] if self.config.profile_use else []),
+                        order_only = self.order_only,
+                        variables = variables)
+            self.precompiled[key] = (pch, objects, self.tools.use_precompiled_header_flags(stub, pch))
+        return self.precompiled.get(key, (None, [], []))
+
+    def precompiled_objects(self, ninja, flags=(), pic=False):
+        return self.precompile(ninja, flags, pic)[1]
+
+    def _record(self, src, obj, flags, pic):
+        key = (src, flags, pic)
+        if pic in self.commands and key not in self.compile_commands:
+            # tools reading the database cannot use our PCH, but can include the header it was built from
+            pch_flags = self.tools.force_include_flags(self.header) if self.header else []
+            command = self.commands[pic].replace(' $pchflags', ''.join(' ' + f for f in pch_flags))
+            command = command.replace(' $extraflags', ''.join(' ' + f for f in flags))
+            self.compile_commands[key] = {
+                'directory': os.getcwd(),
+                'command': command.replace('$in', src).replace('$out', obj),
+                'file': src,
+                'output': obj,
+            }
+
+    def object(self, ninja, src, flags=(), pic=False, members=[]):
+        pic = pic and self.separate_pic
+        key = (src, flags, pic)
+        if key not in self._objects:
+            variant = [v for v in [self.config.name, 'pic' if pic else None, _variant(flags)] if v]
+            obj = object_file(src, path.join(*variant) if variant else None)
+            pch, _, pch_flags = self.precompile(ninja, flags, pic)
+            variables = {}
+            if pch_flags:
+                variables['pchflags'] = ' '.join(pch_flags)
+            if flags:
+                variables['extraflags'] = ' '.join(flags)
+            ninja.build(obj, self.config.rule('cxx_pic' if pic else 'cxx'),
+                        inputs = src,
+                        implicit = [i for i in [pch, self.config.profile_use] if i],
+                        order_only = self.order_only,
+                        variables = variables or None)
+            self._objects[key] = obj
+        for member in members or [src]:
+            self._record(member, self._objects[key], flags, pic)
+        return self._objects[key]
+
+def _compile_flags(tools, includes, defines, flags):
+    return tuple(itertools.chain(
+                (tools.include(i) for i in includes),
+                (tools.define(*d) if isinstance(d, tuple) else tools.define(d) for d in defines),
+                flags
+            ))
+
+_unity_batch = 8
+
+def _unity_batches(sources, batch):
+    # batch boundaries depend on the paths alone: a batch ends after a source whose hash says so.
+    # Adding or removing a file only changes the batch around it.
+    batches = [[]]
+    for src in sorted(sources):
+        batches[-1].append(src)
+        size = len(batches[-1])
+        boundary = int(hashlib.sha1(src.encode('utf-8')).hexdigest()[:8], 16) % batch == 0
+        if (boundary and size > batch // 2) or size >= 2 * batch:
+            batches.append([])
+    return [group for group in batches if group]
+
+def _unity_sources(root, sources, batch, exclude):
+    directory = path.join('obj', 'unity', root, _variant([str(batch)] + list(exclude)))
+    unity = []
+    for group in _unity_batches(sources, batch):
+        # named after the first source, so batches keep their names when others come and go
+        name = path.join(directory, 'unity_%08x.c++' % zlib.crc32(group[0].encode('utf-8')))
+        _write_if_changed(name, ''.join('#include "%s"\n' % path.relpath(src, directory).replace(os.sep, '/')
+                                        for src in group))
+        unity.append((name, group))
+    return unity
+
+def _build_objects(ninja, files, registry, root, flags=(), unity=False, unity_exclude=(), pic=False):
+    sources = files.get(root, '*.c++')
+    if unity:
+        batch = _unity_batch if unity is True else unity
+        excluded = [src for src in sources if any(_pattern(p).match(src) or _pattern(p).match(path.basename(src)) for p in unity_exclude)]
+        batched = [src for src in sources if src not in excluded]
+        unity_sources = _unity_sources(root, batched, batch, unity_exclude)
+        registry.generated.extend(u for u, _ in unity_sources if u not in registry.generated)
+        return ([registry.object(ninja, fn, flags, pic) for fn in excluded]
+              + [registry.object(ninja, u, flags, pic, group) for u, group in unity_sources]
+              + registry.precompiled_objects(ninja, flags, pic))
+    return [registry.object(ninja, fn, flags, pic) for fn in sources] + registry.precompiled_objects(ninja, flags, pic)
+
+def _relative_path(p):
+    try:
+        relative = path.relpath(p)
+    except ValueError: # different drive
+        return p
+    return p if relative.startswith(os.pardir) else relative
+
+_rspfile_threshold = 8000
+
+def _rules_with_rspfile(ninja, tools, name, command, description, pool=None):
+    ninja.rule(name,
+               command = command(input = '$in'),
+               description = description,
+               pool = pool)
+    ninja.rule(name + '_rsp',
+               command = command(input = tools.response_file('$out.rsp')),
+               rspfile = '$out.rsp',
+               rspfile_content = '$in',
+               description = description,
+               pool = pool)
+
+_link_memory = 2 << 30 # bytes a single (LTO) link may use
+
+def _link_jobs():
+    try:
+        memory = os.sysconf('SC_PAGE_SIZE') * os.sysconf('SC_PHYS_PAGES')
+    except (AttributeError, ValueError, OSError):
+        return 1
+    return max(1, min(os.cpu_count() or 1, memory // _link_memory))
+
+def _rspfile_rule(rule, inputs):
+    return rule + '_rsp' if sum(len(i) + 1 for i in inputs) > _rspfile_threshold else rule
+
+def _link_dependencies(target, targets):
+    # libraries in static link order: every library comes before the ones it depends on
+    order = []
+    visiting = []
+    def visit(name):
+        if name not in targets or not hasattr(targets[name], 'link_file'):
+            raise ValueError("'%s' depends on '%s', which is not a library target" % (target.target, name))
+        library = targets[name]
+        if library in order:
+            return
+        if name in visiting:
+            raise ValueError('circular dependency: ' + ' -> '.join(visiting + [name]))
+        visiting.append(name)
+        if not isinstance(library, Vallus.DynamicLibraryTarget):
+            # shared libraries already link their own dependencies
+            for dependency in library.depends:
+                visit(dependency)
+        visiting.pop()
+        order.append(library)
+    for name in target.depends:
+        visit(name)
+    return order[::-1]
+
+def _runtime_path(tools, dependencies):
+    if any(isinstance(lib, Vallus.DynamicLibraryTarget) for lib in dependencies):
+        return {'extraflags': ninja_syntax.escape(' '.join(tools.runtime_path_flags()))}
+    return None
+
+def _target_alias(ninja, config, alias, output):
+    if config.name:
+        ninja.build(alias + '-' + config.name, 'phony',
+                    inputs = output)
+    if config.primary:
+        ninja.build(alias, 'phony',
+                    inputs = output)
 
 class Vallus:
     def __init__(self):
@@ -54,6 +387,10 @@ class Vallus:
         self._defines = []
         self._libraries = []
         self._targets = []
+        self._precompiled_header = None
+        self._generated = []
+        self._training = None
+        self.timings = {}
 
     # setup
     def include(self, inc):
@@ -70,16 +407,33 @@ class Vallus:
     def defines(self, *defs):
         self._defines.extend(defs)
 
+    def precompiled_header(self, header):
+        self._precompiled_header = header
+
+    def generate(self, output, command, inputs=[], always=False):
+        self._generated.append((output, command, list(inputs), always))
+
+    def profile_training(self, target, arguments=[], inputs=[]):
+        self._training = (target, list(arguments), list(inputs))
+
     def library(self, lib):
         self._libraries.append(lib)
     def libraries(self, *libs):
         self._libraries.extend(libs)
 
-    def bootstrap(self, default='docs', custom=None):
+    def bootstrap(self, default='docs', custom=None, sharded=False):
+        timer = _Stopwatch()
+
         # arguments
         parser = argparse.ArgumentParser()
         parser.add_argument('--debug', action='store_true', help='compile with debug information')
+        parser.add_argument('--config', action='append', choices=sorted(_configurations), help='emit a configuration with its own obj/ and bin/ subfolders (can be repeated; overrides --debug)')
+        parser.add_argument('--fast-debug', action='store_true', help='in debug builds, split debug information out of objects and link faster')
+        parser.add_argument('--ld', default=None, choices=['bfd', 'gold', 'lld', 'mold'], help='linker to use (default depends on toolchain)')
         parser.add_argument('--cxx', default=None, metavar='executable', help='compiler name to use (default depends on toolchain)')
+        parser.add_argument('--time-trace', action='store_true', help='make the compiler report where compilation time goes (see python -m vallus profile)')
+        parser.add_argument('--wrap-manifest', action='store_true', help='word-wrap the generated ninja files so they are easier to read (slower on large trees)')
+        parser.add_argument('--compiler-launcher', default=None, metavar='executable', help='command to prefix compilations with (e.g. ccache or sccache)')
 
         tool_arg = parser.add_mutually_exclusive_group()
         tool_arg.add_argument('--gnu', action='store_true', help='use a GNU toolchain (default)')
@@ -87,84 +441,250 @@ class Vallus:
         tool_arg.add_argument('--ms', action='store_true', help='use a Microsoft toolchain')
 
         parser.add_argument('--boost-dir', default=None, metavar='path', help='path of boost folder (i.e. the folder with include/ and lib/ subfolders)')
-        parser.add_argument('--no-lto', action='store_true', help='do not perform link-time optimisation')
+        parser.add_argument('--lto', default='full', choices=['off', 'full', 'thin'], help='kind of link-time optimisation to perform (default: full)')
+        parser.add_argument('--no-lto', dest='lto', action='store_const', const='off', help='do not perform link-time optimisation (same as --lto=off)')
+        parser.add_argument('--lto-jobs', type=int, default=None, metavar='N', help='number of parallel jobs for each link-time optimisation (default depends on toolchain)')
+        parser.add_argument('--pgo', action='store_true', help='build an instrumented variant, run the profile training on it, and optimise release builds with the profile')
+        parser.add_argument('--test-shards', type=int, default=None, metavar='N', help='number of parallel shards check targets run the tests in (default: number of CPUs)')
+        parser.add_argument('--link-jobs', type=int, default=None, metavar='N', help='maximum number of concurrent links (default depends on available memory)')
         args = parser.parse_args()
 
         tools = toolchain.ms.Toolchain() if args.ms else toolchain.llvm.Toolchain() if args.llvm else toolchain.gnu.Toolchain()
         compiler = args.cxx if args.cxx else tools.compiler()
         linker = args.cxx if args.cxx else tools.linker()
         archiver = tools.archiver()
+        lto = None if args.lto == 'off' else args.lto
+
+        # configurations
+        if args.config:
+            configs = [_Configuration(name, **_configurations[name]) for name in sorted(set(args.config), key=args.config.index)]
+        else:
+            configs = [_Configuration(debug = args.debug)]
+        configs[0].primary = True
+        for config in configs:
+            unsupported = [s for s in config.sanitizers if s not in tools.supported_sanitizers()]
+            if unsupported:
+                parser.error('--config %s needs the %s sanitizer, which this toolchain does not support' % (config.name, ', '.join(unsupported)))
+        if args.pgo:
+            if tools.profile_generate_flags() is None:
+                parser.error('--pgo is not supported by this toolchain')
+            if not self._training:
+                parser.error('--pgo needs a profile training (see Vallus.profile_training)')
+            if all(config.debug for config in configs):
+                parser.error('--pgo needs a release configuration')
+            instrumented = _Configuration('instrumented', profile_generate = True)
+            training = path.join(instrumented.obj, 'training.stamp')
+            merge = tools.profile_merge_command(instrumented.obj, '$out')
+            profile = path.join(instrumented.obj, 'default.profdata') if merge else training
+            for config in configs:
+                if not config.debug:
+                    config.profile_use = profile
+            configs.append(instrumented)
 
         # preamble
-        ninja = ninja_syntax.Writer(open('build.ninja', 'w'))
-        ninja.variable('ninja_required_version', '1.3')
+        width = 78 if args.wrap_manifest else None
+        ninja = ninja_syntax.Writer(io.StringIO(), width)
+        ninja.variable('ninja_required_version', '1.7')
         ninja.variable('builddir', 'obj' + os.sep)
         ninja.variable('msvc_deps_prefix', 'Note: including file:')
 
+        shards = {}
+        rules = ninja
+        if sharded:
+            # shards live under obj/ so no target name can collide with build.ninja or with each other
+            rules_shard = path.join('obj', 'ninja', 'rules.ninja')
+            rules = shards[rules_shard] = ninja_syntax.Writer(io.StringIO(), width)
+            ninja.include(rules_shard)
+
+        # pools
+        rules.pool('link_pool', args.link_jobs if args.link_jobs else _link_jobs())
+
         # rules
-        ninja.rule('bootstrap',
+        rules.rule('bootstrap',
                 command = ' '.join(['python'] + sys.argv),
                 generator = True,
+                restat = True,
                 description = 'BOOTSTRAP')
         all_includes = self._includes + [path.join('deps', i, 'include') for i in self._depends]
         if(args.boost_dir):
             all_includes.append(args.boost_dir)
-        ninja.rule('cxx',
-                command = tools.compiler_command(
-                        command = compiler,
-                        dep_output = '$out.d',
-                        debug = args.debug,
-                        lto = not args.no_lto,
-                        warnings = tools.max_warnings(),
-                        includes = all_includes,
-                        defines = self._defines,
-                        extraflags = '$extraflags',
-                        input = '$in',
-                        output = '$out'
-                    ),
-                deps = tools.ninja_deps_style(),
-                depfile = '$out.d',
-                description = 'C++ $in')
-        ninja.rule('link',
-                command = tools.linker_command(
-                        command = linker,
-                        debug = args.debug,
-                        lto = not args.no_lto,
-                        libraries = self._libraries,
-                        libpaths = ['bin'],
-                        extraflags = '$extraflags',
-                        input = '$in',
-                        output = '$out'
-                    ),
-                description = 'LINK $out')
-        ninja.rule('lib',
-                command = tools.archiver_command(
-                        command = archiver,
-                        extraflags = '$extraflags',
+        if args.compiler_launcher:
+            # keep command lines independent of the checkout location so caches can hit
+            all_includes = [_relative_path(i) for i in all_includes]
+        generated = []
+        registries = []
+        for config in configs:
+            if args.ld:
+                ld = args.ld
+            elif config.debug:
+                ld = tools.fast_debug_linker() if args.fast_debug else None
+            else:
+                ld = tools.lto_linker() if lto else None
+            compile_flags = dict(
+                    command = compiler,
+                    dep_output = '$out.d',
+                    debug = config.debug,
+                    fast_debug = args.fast_debug,
+                    lto = lto,
+                    sanitizers = config.sanitizers,
+                    time_trace = args.time_trace,
+                    profile_generate = config.profile_generate,
+                    profile_use = config.profile_use,
+                    warnings = tools.max_warnings(),
+                    includes = all_includes,
+                    defines = self._defines,
+                    prefix_map = os.getcwd() if args.compiler_launcher else None)
+            registry = _ObjectRegistry(config, generated, bool(tools.pic_flags()), tools, self._precompiled_header)
+            for pic in [False, True] if registry.separate_pic else [False]:
+                suffix = '_pic' if pic else ''
+                pic_flags = tools.pic_flags() if pic else []
+                pch_flags = []
+                if self._precompiled_header:
+                    pch_flags = ['$pchflags']
+                    rules.rule(config.rule('pch' + suffix),
+                            command = tools.compiler_command(
+                                    extraflags = ' '.join(pic_flags + ['$pchflags', '$extraflags']),
+                                    input = '$in',
+                                    output = '$pchobject' if tools.precompiled_header_objects('pch') else '$out',
+                                    **compile_flags
+                                ),
+                            deps = tools.ninja_deps_style(),
+                            depfile = '$out.d',
+                            description = 'PCH $in')
+                registry.commands[pic] = tools.compiler_command(
+                        launcher = args.compiler_launcher,
+                        extraflags = ' '.join(pic_flags + pch_flags + ['$extraflags']),
                         input = '$in',
-                        output = '$out'
-                    ),
-                description = 'AR $in')
-        ninja.rule('dylib',
-                command = tools.library_command(
-                        command = linker,
-                        extraflags = '$extraflags',
-                        input = '$in',
-                        output = '$out'
-                    ),
-                description = 'LIB $in')
+                        output = '$out',
+                        **compile_flags
+                    )
+                rules.rule(config.rule('cxx' + suffix),
+                        command = registry.commands[pic],
+                        deps = tools.ninja_deps_style(),
+                        depfile = '$out.d',
+                        description = 'C++ $in')
+            link_flags = dict(
+                    command = linker,
+                    debug = config.debug,
+                    fast_debug = args.fast_debug,
+                    ld = ld,
+                    lto = lto,
+                    lto_jobs = args.lto_jobs,
+                    lto_cache = path.join(config.obj, 'thinlto'),
+                    sanitizers = config.sanitizers,
+                    profile_generate = config.profile_generate,
+                    libraries = self._libraries,
+                    libpaths = [config.bin],
+                    extraflags = '$extraflags',
+                    output = '$out')
+            _rules_with_rspfile(rules, tools, config.rule('link'),
+                    command = functools.partial(tools.linker_command, **link_flags),
+                    description = 'LINK $out',
+                    pool = 'link_pool')
+            _rules_with_rspfile(rules, tools, config.rule('lib'),
+                    command = functools.partial(tools.archiver_command,
+                            command = archiver,
+                            extraflags = '$extraflags',
+                            output = '$out'
+                        ),
+                    description = 'AR $out')
+            _rules_with_rspfile(rules, tools, config.rule('dylib'),
+                    command = functools.partial(tools.library_command,
+                            soname = '$soname',
+                            implib = '$implib',
+                            **link_flags
+                        ),
+                    description = 'LIB $out',
+                    pool = 'link_pool')
+            registries.append(registry)
+
+        rules.rule('generate',
+                command = ' '.join(['python', '-m', __name__, 'generate', '$out', '--', '$generator_command']),
+                restat = True,
+                description = 'GEN $out')
+
+        if args.pgo:
+            rules.rule('train',
+                    command = ' '.join(['python', '-m', __name__, 'train', '$options', '$out', '--', '$in', '$arguments']),
+                    description = 'TRAIN $in')
+            if merge:
+                rules.rule('profdata',
+                        command = merge,
+                        description = 'PROFDATA $out')
+
+        rules.rule('test_plan',
+                command = ' '.join(['python', '-m', __name__, 'test-plan', '--shards', '$shards', '--framework', '$framework', '$out', '--', '$in']),
+                restat = True,
+                description = 'TEST PLAN $in')
+
+        rules.rule('test_shard',
+                command = ' '.join(['python', '-m', __name__, 'test-shard', '--plan', '$plan', '--index', '$index', '--framework', '$framework', '$out', '--', '$in']),
+                description = 'TEST $out')
 
-        ninja.rule('site',
+        rules.rule('site',
                 command = ' '.join(['jekyll', 'build', '--quiet', '--source', '$in', '--destination', '$out']),
-                description = 'JEKYLL $in')
+                description = 'JEKYLL $in',
+                pool = 'link_pool')
 
-        # bootstrap build edge
-        ninja.build('build.ninja', 'bootstrap',
-                implicit = sys.argv[0])
+        timer.lap('rules')
 
         # user-defined targets
+        files = _FileIndex(path.join('obj', 'files.json'))
+        targets = dict((target.target, target) for target in self._targets)
+        if self._generated:
+            for output, command, inputs, always in self._generated:
+                ninja.build(output, 'generate',
+                        implicit = inputs + (['always'] if always else []),
+                        # one argument, so the shell syntax in it applies to the generator command alone
+                        variables = {'generator_command': ninja_syntax.escape(_quote(command))})
+            if any(always for _, _, _, always in self._generated):
+                ninja.build('always', 'phony')
+            ninja.build('generated', 'phony',
+                    inputs = [output for output, _, _, _ in self._generated])
+            for registry in registries:
+                registry.order_only = 'generated'
         for target in self._targets:
-            target.build(tools, ninja)
+            if isinstance(target, self.CheckTarget) and (args.test_shards or not target.shards):
+                target.shards = args.test_shards or os.cpu_count() or 1
+            if isinstance(target, self.DynamicLibraryTarget):
+                # static libraries linked into shared ones need position-independent code
+                for library in _link_dependencies(target, targets):
+                    library.pic = True
+        for target in self._targets:
+            writer = ninja
+            if sharded:
+                shard = path.join('obj', 'ninja', 'targets', target.target + '.ninja')
+                writer = shards[shard] = ninja_syntax.Writer(io.StringIO(), width)
+                ninja.subninja(shard)
+            for registry in registries if target.configurable else registries[:1]:
+                target.build(tools, writer, files, registry, targets)
+        if args.pgo:
+            name, arguments, inputs = self._training
+            if not isinstance(targets.get(name), self.ProgramTarget):
+                raise ValueError("profile training runs '%s', which is not a program target" % name)
+            options = ['--raw', instrumented.obj, '--extension', tools.raw_profile_extension()]
+            options.extend('--env ' + k + '=' + v for k, v in sorted(tools.profile_environment(instrumented.obj).items()))
+            if not merge:
+                # without a merge step, the compiler reads raw profiles next to the objects they belong to
+                options.extend('--collect ' + config.obj for config in configs if config.profile_use)
+            ninja.build(training, 'train',
+                    inputs = targets[name].program_file(tools, registries[-1]),
+                    implicit = inputs,
+                    variables = {'options': ninja_syntax.escape(' '.join(options)),
+                                 'arguments': ninja_syntax.escape(' '.join(arguments))})
+            if merge:
+                ninja.build(profile, 'profdata',
+                        inputs = training)
+        timer.lap('edges')
+        timer.laps['edges'] -= files.scan_time
+        timer.laps['scan'] = files.scan_time
+        files.save()
+        _write_if_changed('compile_commands.json',
+                json.dumps([c for registry in registries for c in registry.compile_commands.values()], indent=2))
+
+        # bootstrap build edge
+        ninja.build(['build.ninja'] + sorted(shards) + generated, 'bootstrap',
+                implicit = sys.argv[0])
 
         # Custom ninja settings
         if custom:
@@ -173,54 +693,155 @@ class Vallus:
         # default target
         ninja.default(default)
 
+        for writer in [ninja] + list(shards.values()):
+            writer.flush()
+        changed = [_write_if_changed(name, shard.output.getvalue()) for name, shard in sorted(shards.items())]
+        if not _write_if_changed('build.ninja', ninja.output.getvalue()) and any(changed):
+            # ninja only reloads its manifest when build.ninja itself is newer
+            os.utime('build.ninja', None)
+        timer.lap('write')
+        self.timings = timer.laps
+
     class ProgramTarget:
-        def __init__(self, target, output, root):
+        configurable = True
+
+        def __init__(self, target, output, root, includes=[], defines=[], flags=[], unity=False, unity_exclude=[], depends=[]):
             self.target = target
             self.root = root
             self.output = output
+            self.includes = list(includes)
+            self.defines = list(defines)
+            self.flags = list(flags)
+            self.unity = unity
+            self.unity_exclude = tuple(unity_exclude)
+            self.depends = list(depends)
 
-        def build(self, tools, ninja):
-            objects = _build_objects(ninja, self.root)
-            binary = path.join('bin', tools.program_name(self.output))
-            ninja.build(binary, 'link',
-                        inputs = objects) # TODO internal dependencies
-            _target_alias(ninja, self.target, binary)
+        def program_file(self, tools, registry):
+            return path.join(registry.config.bin, tools.program_name(self.output))
+
+        def build(self, tools, ninja, files, registry, targets):
+            flags = _compile_flags(tools, self.includes, self.defines, self.flags)
+            objects = _build_objects(ninja, files, registry, self.root, flags, self.unity, self.unity_exclude)
+            dependencies = _link_dependencies(self, targets)
+            libraries = [lib.link_file(tools, registry) for lib in dependencies]
+            binary = self.program_file(tools, registry)
+            ninja.build(binary, _rspfile_rule(registry.config.rule('link'), objects + libraries),
+                        inputs = objects + libraries,
+                        variables = _runtime_path(tools, dependencies))
+            _target_alias(ninja, registry.config, self.target, binary)
 
     class StaticLibraryTarget:
-        def __init__(self, target, output, root):
+        configurable = True
+
+        def __init__(self, target, output, root, includes=[], defines=[], flags=[], unity=False, unity_exclude=[], depends=[]):
             self.target = target
             self.root = root
             self.output = output
+            self.includes = list(includes)
+            self.defines = list(defines)
+            self.flags = list(flags)
+            self.unity = unity
+            self.unity_exclude = tuple(unity_exclude)
+            self.depends = list(depends)
+            self.pic = False
 
-        def build(self, tools, ninja):
-            objects = _build_objects(ninja, self.root)
-            binary = path.join('bin', tools.archive_name(self.output))
-            ninja.build(binary, 'lib',
-                        inputs = objects)
-            _target_alias(ninja, self.target, binary)
+        def link_file(self, tools, registry, pic=False):
+            name = self.output + '_pic' if pic and registry.separate_pic else self.output
+            return path.join(registry.config.bin, tools.archive_name(name))
+
+        def build(self, tools, ninja, files, registry, targets):
+            flags = _compile_flags(tools, self.includes, self.defines, self.flags)
+            _link_dependencies(self, targets) # archives do not link their dependencies, but check them
+            for pic in [False, True] if self.pic and registry.separate_pic else [False]:
+                objects = _build_objects(ninja, files, registry, self.root, flags, self.unity, self.unity_exclude, pic)
+                binary = self.link_file(tools, registry, pic)
+                ninja.build(binary, _rspfile_rule(registry.config.rule('lib'), objects),
+                            inputs = objects)
+            _target_alias(ninja, registry.config, self.target, self.link_file(tools, registry))
 
     class DynamicLibraryTarget:
-        def __init__(self, target, output, root):
+        configurable = True
+
+        def __init__(self, target, output, root, includes=[], defines=[], flags=[], unity=False, unity_exclude=[], depends=[]):
             self.target = target
             self.root = root
             self.output = output
+            self.includes = list(includes)
+            self.defines = list(defines)
+            self.flags = list(flags)
+            self.unity = unity
+            self.unity_exclude = tuple(unity_exclude)
+            self.depends = list(depends)
+
+        def library_file(self, tools, registry):
+            return path.join(registry.config.bin, tools.library_name(self.output))
+
+        def import_file(self, tools, registry):
+            name = tools.import_library_name(self.output)
+            return path.join(registry.config.bin, name) if name else None
+
+        def link_file(self, tools, registry, pic=False):
+            return self.import_file(tools, registry) or self.library_file(tools, registry)
+
+        def build(self, tools, ninja, files, registry, targets):
+            flags = _compile_flags(tools, self.includes, self.defines, self.flags)
+            objects = _build_objects(ninja, files, registry, self.root, flags, self.unity, self.unity_exclude, True)
+            dependencies = _link_dependencies(self, targets)
+            libraries = [lib.link_file(tools, registry, True) for lib in dependencies]
+            binary = self.library_file(tools, registry)
+            implib = self.import_file(tools, registry)
+            variables = _runtime_path(tools, dependencies) or {}
+            variables['soname'] = path.basename(binary)
+            if implib:
+                variables['implib'] = implib
+            ninja.build(binary, _rspfile_rule(registry.config.rule('dylib'), objects + libraries),
+                        inputs = objects + libraries,
+                        implicit_outputs = implib,
+                        variables = variables)
+            _target_alias(ninja, registry.config, self.target, binary)
 
-        def build(self, tools, ninja):
-            objects = _build_objects(ninja, self.root)
-            binary = path.join('bin', tools.library_name(self.output))
-            ninja.build(binary, 'dylib',
-                        inputs = objects)
-            _target_alias(ninja, self.target, binary)
+    class CheckTarget:
+        configurable = True
+
+        def __init__(self, target, runner, framework='catch', inputs=[], shards=None):
+            self.target = target
+            self.runner = runner
+            self.framework = framework
+            self.inputs = list(inputs)
+            self.shards = shards
+
+        def build(self, tools, ninja, files, registry, targets):
+            if not isinstance(targets.get(self.runner), Vallus.ProgramTarget):
+                raise ValueError("'%s' runs '%s', which is not a program target" % (self.target, self.runner))
+            binary = targets[self.runner].program_file(tools, registry)
+            directory = path.join(registry.config.obj, 'check', self.target)
+            plan = path.join(directory, 'plan.json')
+            ninja.build(plan, 'test_plan',
+                    inputs = binary,
+                    implicit = self.inputs,
+                    variables = {'shards': self.shards, 'framework': self.framework})
+            # the plan only gets rebuilt with the runner, so new timings alone never re-run shards
+            stamps = []
+            for index in range(self.shards):
+                stamp = path.join(directory, 'shard-%d.stamp' % index)
+                ninja.build(stamp, 'test_shard',
+                        inputs = binary,
+                        implicit = [plan] + self.inputs,
+                        variables = {'plan': plan, 'index': index, 'framework': self.framework})
+                stamps.append(stamp)
+            _target_alias(ninja, registry.config, self.target, stamps)
 
     class DocumentationTarget:
+        configurable = False
+
         def __init__(self, target, output, root):
             self.target = target
             self.root = root
             self.output = output
 
-        def build(self, tools, ninja):
+        def build(self, tools, ninja, files, registry, targets):
             site = self.output
-            site_files = list(get_files(self.root, '*'))
+            site_files = files.get(self.root, '*')
             ninja.build(site, 'site',
                     inputs = self.root,
                     implicit = site_files)
@@ -228,13 +849,15 @@ class Vallus:
             ninja.build(self.target, 'phony',
                     inputs = site)
 
-    def program(self, target, output, root='src'):
-        self._targets.append(self.ProgramTarget(target, output, root))
-    def test_runner(self, target='test', output='test', root='test'):
-        self.program(target, output, root)
-    def static_library(self, target, output, root='src'):
-        self._targets.append(self.StaticLibraryTarget(target, output, root))
-    def dynamic_library(self, target, output, root='src'):
-        self._targets.append(self.DynamicLibraryTarget(target, output, root))
+    def program(self, target, output, root='src', includes=[], defines=[], flags=[], unity=False, unity_exclude=[], depends=[]):
+        self._targets.append(self.ProgramTarget(target, output, root, includes, defines, flags, unity, unity_exclude, depends))
+    def test_runner(self, target='test', output='test', root='test', includes=[], defines=[], flags=[], unity=False, unity_exclude=[], depends=[]):
+        self.program(target, output, root, includes, defines, flags, unity, unity_exclude, depends)
+    def static_library(self, target, output, root='src', includes=[], defines=[], flags=[], unity=False, unity_exclude=[], depends=[]):
+        self._targets.append(self.StaticLibraryTarget(target, output, root, includes, defines, flags, unity, unity_exclude, depends))
+    def dynamic_library(self, target, output, root='src', includes=[], defines=[], flags=[], unity=False, unity_exclude=[], depends=[]):
+        self._targets.append(self.DynamicLibraryTarget(target, output, root, includes, defines, flags, unity, unity_exclude, depends))
+    def check(self, target='check', runner='test', framework='catch', inputs=[], shards=None):
+        self._targets.append(self.CheckTarget(target, runner, framework, inputs, shards))
     def documentation(self, target='docs', output=path.join('dist', 'doc'), root='doc'):
         self._targets.append(self.DocumentationTarget(target, output, root))
@@ -0,0 +1,280 @@
+# Vallus
+#
+# Written in 2015 by Martinho Fernandes <rmf@rmf.io>
+#
+# To the extent possible under law, the author(s) have dedicated all copyright and related
+# and neighboring rights to this software to the public domain worldwide. This software is
+# distributed without any warranty.
+#
+# You should have received a copy of the CC0 Public Domain Dedication along with this software.
+# If not, see <http://creativecommons.org/publicdomain/zero/1.0/>.
+#
+# Command-line tools used by and alongside generated build files
+
+from os import path
+import argparse
+import json
+import os
+import re
+import shutil
+import subprocess
+
+from . import _write_if_changed
+from . import get_files
+from . import bench
+from . import check
+from . import watch
+
+def generate(args):
+    content = subprocess.check_output(' '.join(args.command), shell=True)
+    _write_if_changed(args.output, content.decode('utf-8'))
+
+def train(args):
+    pattern = '*' + args.extension
+    for f in list(get_files(args.raw, pattern)):
+        os.remove(f) # stale profiles would be merged into the new ones
+    environment = dict(os.environ)
+    environment.update(e.split('=', 1) for e in args.env)
+    subprocess.check_call(args.command, env=environment)
+    for f in get_files(args.raw, pattern):
+        for destination in args.collect:
+            target = path.join(destination, path.relpath(f, args.raw))
+            os.makedirs(path.dirname(target), exist_ok=True)
+            shutil.copyfile(f, target)
+    with open(args.output, 'w'):
+        pass
+
+# manifest and log readers
+def _tokens(line):
+    return [re.sub(r'\$(.)', r'\1', t) for t in re.findall(r'(?:\$.|[^ $])+', line)]
+
+def _manifest_lines(filename):
+    line = ''
+    with open(filename) as f:
+        for raw in f:
+            raw = raw.rstrip('\n')
+            if line:
+                raw = raw.lstrip(' ')
+            if (len(raw) - len(raw.rstrip('$'))) % 2 == 1:
+                line += raw[:-1]
+                continue
+            yield line + raw
+            line = ''
+
+def read_manifest(filename='build.ninja', edges=None):
+    # maps each output to (rule, explicit inputs, implicit inputs)
+    edges = {} if edges is None else edges
+    for line in _manifest_lines(filename):
+        if line.startswith('include ') or line.startswith('subninja '):
+            read_manifest(line.split(' ', 1)[1], edges)
+        if not line.startswith('build '):
+            continue
+        tokens = _tokens(line[len('build '):])
+        split = next(i for i, t in enumerate(tokens) if t.endswith(':') and not t.endswith('$:'))
+        outputs = [t for t in tokens[:split] + [tokens[split][:-1]] if t and t != '|']
+        rule = tokens[split + 1]
+        inputs, implicit = [], []
+        current = inputs
+        for t in tokens[split + 2:]:
+            if t == '|':
+                current = implicit
+            elif t == '||':
+                break
+            else:
+                current.append(t)
+        for output in outputs:
+            edges[output] = (rule, inputs, implicit)
+    return edges
+
+def read_log(filename):
+    # maps each output to the duration of its most recent build, in seconds
+    durations = {}
+    with open(filename) as f:
+        for line in f:
+            fields = line.rstrip('\n').split('\t')
+            if line.startswith('#') or len(fields) < 4:
+                continue
+            durations[fields[3]] = (int(fields[1]) - int(fields[0])) / 1000.0
+    return durations
+
+# profile
+def _is_binary(rule):
+    return re.match(r'(link|lib|dylib)(_|$)', rule)
+
+def _critical_path(edges, durations):
+    paths = {}
+    def visit(output):
+        if output not in paths:
+            paths[output] = (0, [])
+            rule, inputs, implicit = edges.get(output, (None, [], []))
+            slowest = max([visit(i) for i in inputs + implicit] or [(0, [])])
+            own = durations.get(output, 0)
+            paths[output] = (slowest[0] + own, slowest[1] + [output] if own else slowest[1])
+        return paths[output]
+    return max([visit(output) for output in edges] or [(0, [])])
+
+def _trace_totals(objects):
+    totals = {}
+    headers = {}
+    for obj in objects:
+        trace = re.sub(r'\.(o|obj)$', '.json', obj)
+        if not path.isfile(trace):
+            continue
+        with open(trace) as f:
+            events = json.load(f).get('traceEvents', [])
+        for event in events:
+            name = event.get('name', '')
+            duration = event.get('dur', 0) / 1e6
+            if name.startswith('Total '):
+                totals[name[len('Total '):]] = totals.get(name[len('Total '):], 0) + duration
+            elif name == 'Source':
+                header = event.get('args', {}).get('detail', '')
+                headers[header] = headers.get(header, 0) + duration
+    return totals, headers
+
+def _table(title, rows, top, format='%9.3fs'):
+    print(title)
+    for value, name in sorted(rows, reverse=True)[:top]:
+        print('  ' + format % value + '  ' + name)
+    print('')
+
+def profile(args):
+    edges = read_manifest(args.manifest)
+    durations = read_log(args.log)
+    compiles = dict((output, edge[1][0]) for output, edge in edges.items()
+                    if re.match(r'cxx(_|$)', edge[0]) and edge[1])
+
+    _table('Slowest compiles:', [(durations[o], '%s (%s)' % (src, o)) for o, src in compiles.items() if o in durations], args.top)
+    _table('Slowest links:', [(durations[o], o) for o, edge in edges.items() if _is_binary(edge[0]) and o in durations], args.top)
+
+    total, chain = _critical_path(edges, durations)
+    print('Critical path: %.3fs' % total)
+    for output in chain:
+        print('  %9.3fs  %s' % (durations[output], compiles.get(output, output)))
+    print('')
+
+    targets = []
+    for alias, (rule, inputs, _) in edges.items():
+        if rule != 'phony':
+            continue
+        for binary in inputs:
+            if binary in edges and _is_binary(edges[binary][0]):
+                steps = [binary] + edges[binary][1]
+                targets.append((sum(durations.get(s, 0) for s in steps), '%s (%d steps)' % (alias, len(steps))))
+    _table('Per target:', targets, len(targets))
+
+    if args.traces:
+        totals, headers = _trace_totals(compiles)
+        _table('Compiler phases (from -ftime-trace):', [(t, name) for name, t in totals.items()], args.top)
+        _table('Most expensive headers, inclusive (from -ftime-trace):', [(t, name) for name, t in headers.items()], args.top)
+
+# header dependencies
+def read_deps(ninja='ninja'):
+    # maps each compiled file to its dependencies, from the ninja deps log
+    output = subprocess.check_output([ninja, '-t', 'deps'])
+    deps = {}
+    current = None
+    for line in output.decode('utf-8').splitlines():
+        if not line.strip():
+            current = None
+        elif not line.startswith(' '):
+            current = deps.setdefault(line.split(': #deps')[0], [])
+        elif current is not None:
+            current.append(line.strip())
+    return deps
+
+def read_depfiles(root='obj'):
+    # same, from the depfiles the compiler wrote (ninja deletes them once it has read them)
+    deps = {}
+    for depfile in get_files(root, '*.d'):
+        with open(depfile) as f:
+            text = f.read().replace('\\\n', ' ')
+        output, _, prerequisites = text.partition(': ')
+        deps[output.strip()] = [p.replace('\\ ', ' ') for p in re.findall(r'(?:\\ |\S)+', prerequisites)]
+    return deps
+
+def deps_report(args):
+    deps = read_depfiles(args.depfiles) if args.depfiles else read_deps(args.ninja)
+    durations = read_log(args.log) if path.isfile(args.log) else {}
+    dependents = {}
+    for output, files in deps.items():
+        for f in files:
+            if not f.endswith('.c++'):
+                dependents.setdefault(path.normpath(f), []).append(output)
+    sizes = dict((h, path.getsize(h) if path.isfile(h) else 0) for h in dependents)
+
+    _table('Most included headers:', [(len(outputs), h) for h, outputs in dependents.items()], args.top, '%6d TUs')
+    _table('Most expensive headers (fan-in x size):', [(len(outputs) * sizes[h] / 1024.0, h) for h, outputs in dependents.items()], args.top, '%6.0f KiB')
+    if durations:
+        _table('Most recompilation when touched (from the ninja log):',
+               [(sum(durations.get(o, 0) for o in outputs), h) for h, outputs in dependents.items()], args.top)
+    if args.traces:
+        _, headers = _trace_totals(deps)
+        _table('Most expensive headers, inclusive parse time (from -ftime-trace):', [(t, name) for name, t in headers.items()], args.top)
+
+def main():
+    parser = argparse.ArgumentParser(prog='vallus')
+    commands = parser.add_subparsers(dest='tool')
+    commands.required = True
+
+    generate_command = commands.add_parser('generate', help='write the output of a command to a file, only if it changed')
+    generate_command.add_argument('output', help='file to write')
+    generate_command.add_argument('command', nargs=argparse.REMAINDER, help='shell command whose standard output is the file content')
+    generate_command.set_defaults(run=generate)
+
+    train_command = commands.add_parser('train', help='run a profile training command and stamp a file when it succeeds')
+    train_command.add_argument('output', help='stamp file to write')
+    train_command.add_argument('--raw', required=True, metavar='path', help='folder the instrumented program writes its profiles to')
+    train_command.add_argument('--extension', required=True, metavar='ext', help='extension of the raw profile files')
+    train_command.add_argument('--env', action='append', default=[], metavar='var=value', help='environment variable to run the command with (can be repeated)')
+    train_command.add_argument('--collect', action='append', default=[], metavar='path', help='folder to copy the raw profiles to, keeping their relative paths (can be repeated)')
+    train_command.add_argument('command', nargs=argparse.REMAINDER, help='training command')
+    train_command.set_defaults(run=train)
+
+    plan_command = commands.add_parser('test-plan', help='split the tests of a test runner into balanced shards')
+    plan_command.add_argument('output', help='plan file to write, next to the timings of previous runs')
+    plan_command.add_argument('--shards', type=int, required=True, metavar='N', help='number of shards')
+    plan_command.add_argument('--framework', default='catch', choices=sorted(check._frameworks), help='test framework of the runner (default: catch)')
+    plan_command.add_argument('command', nargs=argparse.REMAINDER, help='test runner command')
+    plan_command.set_defaults(run=check.test_plan)
+
+    shard_command = commands.add_parser('test-shard', help='run one shard of a test plan and stamp a file when it passes')
+    shard_command.add_argument('output', help='stamp file to write')
+    shard_command.add_argument('--plan', required=True, metavar='file', help='plan file written by test-plan')
+    shard_command.add_argument('--index', type=int, required=True, metavar='N', help='shard to run')
+    shard_command.add_argument('--framework', default='catch', choices=sorted(check._frameworks), help='test framework of the runner (default: catch)')
+    shard_command.add_argument('command', nargs=argparse.REMAINDER, help='test runner command')
+    shard_command.set_defaults(run=check.test_shard)
+
+    watch_command = commands.add_parser('watch', help='rebuild when sources change, rebootstrapping when files are added or removed')
+    watch_command.add_argument('--ninja', default='ninja', metavar='executable', help='ninja executable to run (default: ninja)')
+    watch_command.add_argument('command', nargs=argparse.REMAINDER, metavar='ninja-args', help='targets and options to run ninja with')
+    watch_command.set_defaults(run=watch.watch)
+
+    profile_command = commands.add_parser('profile', help='report where build time goes, from the ninja log')
+    profile_command.add_argument('--log', default=path.join('obj', '.ninja_log'), metavar='file', help='ninja log to read (default: obj/.ninja_log)')
+    profile_command.add_argument('--manifest', default='build.ninja', metavar='file', help='ninja manifest to read (default: build.ninja)')
+    profile_command.add_argument('--top', type=int, default=10, metavar='N', help='number of entries in each report (default: 10)')
+    profile_command.add_argument('--traces', action='store_true', help='also aggregate the -ftime-trace files from a --time-trace build')
+    profile_command.set_defaults(run=profile)
+
+    deps_command = commands.add_parser('deps-report', help='rank headers by how much compilation they cause')
+    deps_command.add_argument('--ninja', default='ninja', metavar='executable', help='ninja executable to read the deps log with (default: ninja)')
+    deps_command.add_argument('--depfiles', default=None, metavar='path', help='read the depfiles under this folder instead of the ninja deps log')
+    deps_command.add_argument('--log', default=path.join('obj', '.ninja_log'), metavar='file', help='ninja log to weigh recompilation with (default: obj/.ninja_log)')
+    deps_command.add_argument('--top', type=int, default=10, metavar='N', help='number of entries in each report (default: 10)')
+    deps_command.add_argument('--traces', action='store_true', help='also rank headers by parse time from the -ftime-trace files of a --time-trace build')
+    deps_command.set_defaults(run=deps_report)
+
+    bench_command = commands.add_parser('bench', help='time manifest generation on synthetic source trees')
+    bench_command.add_argument('--sizes', type=int, nargs='+', default=[1000, 10000, 100000], metavar='N', help='numbers of source files to generate trees with (default: 1000 10000 100000)')
+    bench_command.add_argument('--results', default='bench.jsonl', metavar='file', help='file to append results to and compare against (default: bench.jsonl)')
+    bench_command.set_defaults(run=bench.bench)
+
+    args = parser.parse_args()
+    if getattr(args, 'command', None) and args.command[0] == '--':
+        args.command = args.command[1:]
+    args.run(args)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,140 @@
+# Vallus
+#
+# Written in 2015 by Martinho Fernandes <rmf@rmf.io>
+#
+# To the extent possible under law, the author(s) have dedicated all copyright and related
+# and neighboring rights to this software to the public domain worldwide. This software is
+# distributed without any warranty.
+#
+# You should have received a copy of the CC0 Public Domain Dedication along with this software.
+# If not, see <http://creativecommons.org/publicdomain/zero/1.0/>.
+#
+# Benchmarks for manifest generation on synthetic source trees
+
+from os import path
+import json
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+from . import _racy
+
+_targets = 8 # number of libraries the sources are spread across
+_files_per_dir = 50
+_regression = 1.1 # slowdown relative to the previous run that gets flagged
+_noise = 0.01 # seconds; smaller differences are not flagged
+
+# the bootstrap script of a synthetic tree; prints its own timings as JSON
+_script = '''import json
+import sys
+import time
+sys.path.insert(0, {parent!r})
+try:
+    import resource
+except ImportError:
+    resource = None
+
+start = time.perf_counter()
+import {package} as vallus
+v = vallus.Vallus()
+{targets}
+v.program('main', 'main', root='src', depends={libraries!r})
+v.bootstrap(default='main')
+timings = dict(v.timings, total=time.perf_counter() - start)
+if resource:
+    scale = 1 if sys.platform == 'darwin' else 1024 # ru_maxrss is in KiB on Linux
+    timings['peak_memory'] = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * scale
+print(json.dumps(timings))
+'''
+
+def synthesise(root, count):
+    libraries = ['lib%d' % i for i in range(_targets)]
+    for n in range(count):
+        library = libraries[n % len(libraries)]
+        index = n // len(libraries)
+        directory = path.join(root, library, 'd%d' % (index // _files_per_dir))
+        if not path.isdir(directory):
+            os.makedirs(directory)
+        with open(path.join(directory, 'f%d.c++' % index), 'w') as f:
+            f.write('int %s_f%d() { return %d; }\n' % (library, index, n))
+    os.makedirs(path.join(root, 'src'))
+    with open(path.join(root, 'src', 'main.c++'), 'w') as f:
+        f.write('int main() {}\n')
+    os.makedirs(path.join(root, 'include'))
+    package = path.dirname(path.abspath(__file__))
+    with open(path.join(root, 'build.py'), 'w') as f:
+        f.write(_script.format(
+                parent = path.dirname(package),
+                package = path.basename(package),
+                targets = '\n'.join("v.static_library(%r, %r, root=%r)" % (l, l, l) for l in libraries),
+                libraries = libraries))
+
+def run(root, args=['--no-lto']):
+    output = subprocess.check_output([sys.executable, 'build.py'] + args, cwd=root)
+    return json.loads(output.decode('utf-8').splitlines()[-1])
+
+def _backdate(root):
+    # directories modified within the racy window are never cached, so age the tree past it
+    stamp = time.time() - 2 * _racy / 1e9
+    for dir, dirs, _ in os.walk(root):
+        dirs[:] = [d for d in dirs if d not in ('obj', 'bin')]
+        os.utime(dir, (stamp, stamp))
+
+def measure(count):
+    root = tempfile.mkdtemp(prefix='vallus-bench-')
+    try:
+        start = time.perf_counter()
+        synthesise(root, count)
+        setup = time.perf_counter() - start
+        cold = run(root)
+        _backdate(root)
+        run(root) # caches the listings of the now old directories
+        warm = run(root)
+        size = path.getsize(path.join(root, 'build.ninja'))
+    finally:
+        shutil.rmtree(root, ignore_errors=True)
+    return dict(files = count, setup = setup, cold = cold, warm = warm, manifest_size = size)
+
+def _previous(results, count):
+    for result in reversed(results):
+        if result['files'] == count:
+            return result
+    return None
+
+def _load(filename):
+    try:
+        with open(filename) as f:
+            return [json.loads(line) for line in f if line.strip()]
+    except OSError:
+        return []
+
+_phases = ['scan', 'rules', 'edges', 'write', 'total']
+
+def report(result, previous=None):
+    print('%d files (%.1f MiB manifest, tree set up in %.1fs)' % (result['files'], result['manifest_size'] / 2.0**20, result['setup']))
+    for kind in ['cold', 'warm']:
+        timings = result[kind]
+        line = '  %-5s' % kind + ''.join('  %s %8.3fs' % (phase, timings[phase]) for phase in _phases)
+        if 'peak_memory' in timings:
+            line += '  peak %6.1f MiB' % (timings['peak_memory'] / 2.0**20)
+        print(line)
+        if previous:
+            slower = [phase for phase in _phases
+                      if timings[phase] > previous[kind][phase] * _regression + _noise]
+            for phase in slower:
+                print('    REGRESSION: %s %s took %.3fs, was %.3fs' % (kind, phase, timings[phase], previous[kind][phase]))
+
+def bench(args):
+    history = _load(args.results)
+    results = []
+    for count in args.sizes:
+        result = measure(count)
+        result['time'] = time.strftime('%Y-%m-%dT%H:%M:%S')
+        report(result, _previous(history, count))
+        results.append(result)
+    with open(args.results, 'a') as f:
+        for result in results:
+            f.write(json.dumps(result, sort_keys=True) + '\n')
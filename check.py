@@ -0,0 +1,136 @@
+# Vallus
+#
+# Written in 2015 by Martinho Fernandes <rmf@rmf.io>
+#
+# To the extent possible under law, the author(s) have dedicated all copyright and related
+# and neighboring rights to this software to the public domain worldwide. This software is
+# distributed without any warranty.
+#
+# You should have received a copy of the CC0 Public Domain Dedication along with this software.
+# If not, see <http://creativecommons.org/publicdomain/zero/1.0/>.
+#
+# Sharded test execution for the check target
+
+from os import path
+import glob
+import json
+import os
+import re
+import subprocess
+import sys
+
+from . import _write_if_changed
+
+def _catch_tests(output):
+    return [line.strip() for line in output.splitlines() if line.strip()]
+
+def _gtest_tests(output):
+    tests = []
+    suite = ''
+    for line in output.splitlines():
+        line = line.split('#')[0].rstrip()
+        if not line:
+            continue
+        if line.startswith(' '):
+            tests.append(suite + line.strip())
+        else:
+            suite = line
+    return tests
+
+def _catch_select(names, listing):
+    # names go through a file, quoted and escaped, so that Catch matches them literally
+    # instead of reading ',', '[', '*' or '~' as test spec syntax
+    with open(listing, 'w') as f:
+        for name in names:
+            f.write('"%s"\n' % re.sub(r'([\\"*,\[\]~])', r'\\\1', name))
+    return ['--input-file', listing, '--durations', 'yes'], {}
+
+def _gtest_select(names, listing):
+    # the filter goes through the environment, so long shards do not make long command lines
+    return [], {'GTEST_FILTER': ':'.join(names)}
+
+# how to list tests, run a selection of them, and read their durations, per test framework
+_frameworks = {
+    'catch': dict(
+        list = ['--list-test-names-only'],
+        tests = _catch_tests,
+        select = _catch_select,
+        duration = lambda m: (m.group(2), float(m.group(1))),
+        pattern = re.compile(r'^(\d+(?:\.\d+)?) s: (.*)$', re.M)),
+    'gtest': dict(
+        list = ['--gtest_list_tests'],
+        tests = _gtest_tests,
+        select = _gtest_select,
+        duration = lambda m: (m.group(1), int(m.group(2)) / 1000.0),
+        pattern = re.compile(r'^\[       OK \] (\S+) \((\d+) ms\)', re.M)),
+}
+
+def _timings_file(directory, index):
+    return path.join(directory, 'timings-%d.json' % index)
+
+def _timings(directory):
+    timings = {}
+    files = glob.glob(path.join(directory, 'timings-*.json'))
+    # a test moves between shards as they are rebalanced; its latest run wins
+    for f in sorted(files, key=os.path.getmtime):
+        try:
+            with open(f) as timings_file:
+                timings.update(json.load(timings_file))
+        except (OSError, ValueError):
+            pass
+    return timings
+
+def balance(tests, timings, shards):
+    """Splits 'tests' into 'shards' lists that take about the same time to run.
+
+    Tests without timings are assumed to take as long as the average test."""
+    known = [timings[t] for t in tests if t in timings]
+    default = sum(known) / len(known) if known else 1.0
+    loads = [(0.0, n) for n in range(shards)]
+    plan = [[] for _ in range(shards)]
+    for test in sorted(tests, key=lambda t: (-timings.get(t, default), t)):
+        load, n = min(loads)
+        plan[n].append(test)
+        loads[n] = (load + timings.get(test, default), n)
+    return plan
+
+def _stamp(filename):
+    with open(filename, 'w'):
+        pass
+
+def test_plan(args):
+    framework = _frameworks[args.framework]
+    output = subprocess.check_output(args.command + framework['list'])
+    tests = framework['tests'](output.decode('utf-8'))
+    directory = path.dirname(args.output)
+    plan = balance(tests, _timings(directory), args.shards)
+    _write_if_changed(args.output, json.dumps(plan, indent=2))
+
+def test_shard(args):
+    framework = _frameworks[args.framework]
+    with open(args.plan) as f:
+        plan = json.load(f)
+    tests = plan[args.index] if args.index < len(plan) else []
+    if not tests:
+        _stamp(args.output)
+        return
+    listing = path.join(path.dirname(args.plan), 'shard-%d.tests' % args.index)
+    arguments, variables = framework['select'](tests, listing)
+    environment = dict(os.environ)
+    environment.update(variables)
+    process = subprocess.run(args.command + arguments, env=environment,
+                             stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
+    output = process.stdout.decode('utf-8', 'replace')
+    durations = dict(framework['duration'](m) for m in framework['pattern'].finditer(output))
+    timings = dict((t, durations[t]) for t in tests if t in durations)
+    with open(_timings_file(path.dirname(args.plan), args.index), 'w') as f:
+        json.dump(timings, f, indent=2, sort_keys=True)
+    if process.returncode != 0:
+        sys.stdout.write(output)
+        sys.exit(process.returncode)
+    missing = [t for t in tests if t not in durations]
+    if missing:
+        # a test that did not run has not passed
+        sys.stdout.write(output)
+        sys.exit('tests did not run: ' + ', '.join(missing))
+    _stamp(args.output)
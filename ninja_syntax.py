@@ -10,20 +10,44 @@ use Python.
 import textwrap
 import re
 
+_path_escapes = {'$ ': '$$$ ', ' ': '$ ', ':': '$:'}
+_path_escape_re = re.compile(r'\$ | |:')
+
 def escape_path(word):
-    return word.replace('$ ','$$ ').replace(' ','$ ').replace(':', '$:')
+    if ' ' not in word and ':' not in word:
+        return word
+    return _path_escape_re.sub(lambda m: _path_escapes[m.group()], word)
 
 class Writer(object):
+    """Writes ninja syntax to 'output'.
+
+    Lines are word-wrapped at 'width' characters. With a width of None
+    nothing is wrapped and all text is kept in a buffer that is written to
+    'output' in one go by flush() or close()."""
     def __init__(self, output, width=78):
         self.output = output
         self.width = width
+        self._buffer = [] if width is None else None
+        self._write = self._buffer.append if width is None else output.write
+
+    def flush(self):
+        if self._buffer:
+            self.output.write(''.join(self._buffer))
+            del self._buffer[:]
+
+    def close(self):
+        self.flush()
+        self.output.close()
 
     def newline(self):
-        self.output.write('\n')
+        self._write('\n')
 
     def comment(self, text):
+        if self.width is None:
+            self._write('# ' + text + '\n')
+            return
         for line in textwrap.wrap(text, self.width - 2):
-            self.output.write('# ' + line + '\n')
+            self._write('# ' + line + '\n')
 
     def variable(self, key, value, indent=0):
         if value is None:
@@ -59,23 +83,25 @@ class Writer(object):
             self.variable('deps', deps, indent=1)
 
     def build(self, outputs, rule, inputs=None, implicit=None, order_only=None,
-              variables=None):
+              variables=None, implicit_outputs=None):
         outputs = self._as_list(outputs)
-        all_inputs = self._as_list(inputs)[:]
-        out_outputs = list(map(escape_path, outputs))
-        all_inputs = list(map(escape_path, all_inputs))
+        out_outputs = [escape_path(o) for o in outputs]
+        all_inputs = [rule]
+        all_inputs.extend(escape_path(i) for i in self._as_list(inputs))
+
+        if implicit_outputs:
+            out_outputs.append('|')
+            out_outputs.extend(escape_path(o) for o in self._as_list(implicit_outputs))
 
         if implicit:
-            implicit = map(escape_path, self._as_list(implicit))
             all_inputs.append('|')
-            all_inputs.extend(implicit)
+            all_inputs.extend(escape_path(i) for i in self._as_list(implicit))
         if order_only:
-            order_only = map(escape_path, self._as_list(order_only))
             all_inputs.append('||')
-            all_inputs.extend(order_only)
+            all_inputs.extend(escape_path(i) for i in self._as_list(order_only))
 
         self._line('build %s: %s' % (' '.join(out_outputs),
-                                        ' '.join([rule] + all_inputs)))
+                                        ' '.join(all_inputs)))
 
         if variables:
             if isinstance(variables, dict):
@@ -97,50 +123,54 @@ class Writer(object):
     def default(self, paths):
         self._line('default %s' % ' '.join(self._as_list(paths)))
 
-    def _count_dollars_before_index(self, s, i):
-      """Returns the number of '$' characters right in front of s[i]."""
-      dollar_count = 0
+    def _escaped_space(self, s, start, i):
+      """Whether s[i] is a space escaped by the '$' characters in s[start:i].
+
+      Never looks at s[start] itself, which starts a line."""
       dollar_index = i - 1
-      while dollar_index > 0 and s[dollar_index] == '$':
-        dollar_count += 1
+      while dollar_index > start and s[dollar_index] == '$':
         dollar_index -= 1
-      return dollar_count
+      return (i - 1 - dollar_index) % 2 == 1
 
     def _line(self, text, indent=0):
         """Write 'text' word-wrapped at self.width characters."""
         leading_space = '  ' * indent
-        while len(leading_space) + len(text) > self.width:
+        if self.width is None:
+            self._write(leading_space + text + '\n')
+            return
+        # wrapping walks an offset through the text instead of slicing it, so
+        # very long lines (e.g. links) do not get copied once per fragment
+        start = 0
+        while len(leading_space) + len(text) - start > self.width:
             # The text is too wide; wrap if possible.
 
             # Find the rightmost space that would obey our width constraint and
             # that's not an escaped space.
             available_space = self.width - len(leading_space) - len(' $')
-            space = available_space
+            space = start + available_space
             while True:
-              space = text.rfind(' ', 0, space)
-              if space < 0 or \
-                 self._count_dollars_before_index(text, space) % 2 == 0:
+              space = text.rfind(' ', start, space)
+              if space < 0 or not self._escaped_space(text, start, space):
                 break
 
             if space < 0:
                 # No such space; just use the first unescaped space we can find.
-                space = available_space - 1
+                space = start + available_space - 1
                 while True:
                   space = text.find(' ', space + 1)
-                  if space < 0 or \
-                     self._count_dollars_before_index(text, space) % 2 == 0:
+                  if space < 0 or not self._escaped_space(text, start, space):
                     break
             if space < 0:
                 # Give up on breaking.
                 break
 
-            self.output.write(leading_space + text[0:space] + ' $\n')
-            text = text[space+1:]
+            self._write(leading_space + text[start:space] + ' $\n')
+            start = space + 1
 
             # Subsequent lines are continuations, so indent them.
             leading_space = '  ' * (indent+2)
 
-        self.output.write(leading_space + text + '\n')
+        self._write(leading_space + text[start:] + '\n')
 
     def _as_list(self, input):
         if input is None:
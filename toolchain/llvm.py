@@ -12,6 +12,7 @@
 # LLVM toolchain
 
 import itertools
+from os import path
 
 class Toolchain:
     def compiler(self):
@@ -31,25 +32,39 @@ class Toolchain:
 
     def compiler_command(self,
                          command = 'g++',
+                         launcher = None,
                          dep_output = None,
                          debug = False,
-                         lto = True,
+                         fast_debug = False,
+                         lto = 'full',
+                         sanitizers = [],
+                         time_trace = False,
+                         profile_generate = False,
+                         profile_use = None,
                          warnings = [],
                          includes = [],
                          defines = [],
+                         prefix_map = None,
                          extraflags = '',
                          input = '',
                          output = ''):
         return ' '.join(itertools.chain(
+                    [launcher] if launcher else [],
                     [command],
                     ['-MMD','-MF ' + dep_output],
                     ['-c', '-stdlib=libc++', '-std=c++11', '-pthread'],
                     self.debug_flags() if debug else self.opt_flags(),
-                    self.lto_flags() if lto and not debug else [],
+                    self.fast_debug_flags() if debug and fast_debug else [],
+                    self.compiler_lto_flags(lto) if lto and not debug else [],
+                    self.sanitizer_flags(sanitizers) if sanitizers else [],
+                    self.time_trace_flags() if time_trace else [],
+                    self.profile_generate_flags() if profile_generate else [],
+                    self.profile_use_flags(profile_use) if profile_use else [],
                     warnings,
                     [self.include('include')],
                     (self.dep_include(i) for i in includes),
-                    (self.define(*kv) for kv in defines),
+                    (self.define(*kv) if isinstance(kv, tuple) else self.define(kv) for kv in defines),
+                    self.prefix_map_flags(prefix_map) if prefix_map else [],
                     [extraflags],
                     ['-o', output],
                     [input]
@@ -60,14 +75,24 @@ class Toolchain:
                        libraries = [],
                        libpaths = [],
                        debug = False,
-                       lto = True,
+                       fast_debug = False,
+                       ld = None,
+                       lto = 'full',
+                       lto_jobs = None,
+                       lto_cache = None,
+                       sanitizers = [],
+                       profile_generate = False,
                        extraflags = '',
                        input = '',
                        output = ''):
         return ' '.join(itertools.chain(
                     [command],
                     ['-stdlib=libc++', '-std=c++11', '-pthread'],
-                    self.lto_flags() if lto and not debug else [],
+                    self.linker_lto_flags(lto, lto_jobs, lto_cache) if lto and not debug else [],
+                    self.linker_sanitizer_flags(sanitizers) if sanitizers else [],
+                    self.profile_generate_flags() if profile_generate else [],
+                    self.ld_flags(ld) if ld else [],
+                    self.fast_debug_link_flags(ld) if debug and fast_debug else [],
                     (self.libpath(p) for p in libpaths),
                     [extraflags],
                     ['-o', output],
@@ -91,10 +116,19 @@ class Toolchain:
 
     def library_command(self,
                         command = linker,
+                        soname = None,
+                        implib = None,
                         extraflags = '',
-                        input = '',
-                        output = ''):
-        return 'foo'
+                        **kwargs):
+        return self.linker_command(
+                    command = command,
+                    extraflags = ' '.join(itertools.chain(
+                            ['-shared'],
+                            ['-Wl,-soname,' + soname] if soname else [],
+                            [extraflags]
+                        )),
+                    **kwargs
+                )
 
     def program_name(self, output):
         return output
@@ -102,6 +136,8 @@ class Toolchain:
         return 'lib' + output + '.a'
     def library_name(self, output):
         return 'lib' + output + '.so'
+    def import_library_name(self, output):
+        return None
 
     def include(self, i):
         return '-I' + i;
@@ -118,8 +154,69 @@ class Toolchain:
         return ['-g', '-Og']
     def opt_flags(self):
         return ['-O3']
-    def lto_flags(self):
+    def compiler_lto_flags(self, lto):
+        return ['-flto=thin' if lto == 'thin' else '-flto']
+    def linker_lto_flags(self, lto, jobs=None, cache=None):
+        if lto != 'thin':
+            return ['-flto']
+        return list(itertools.chain(
+                    ['-flto=thin'],
+                    ['-Wl,--thinlto-jobs=%d' % jobs] if jobs else [],
+                    ['-Wl,--thinlto-cache-dir=' + cache] if cache else []
+                ))
+    def lto_linker(self):
+        return 'lld'
+
+    def time_trace_flags(self):
+        return ['-ftime-trace']
+    def pic_flags(self):
+        return ['-fPIC']
+    def runtime_path_flags(self):
+        return ["'-Wl,-rpath,$ORIGIN'"]
+
+    def supported_sanitizers(self):
+        return ['address', 'undefined', 'thread']
+    def sanitizer_flags(self, sanitizers):
+        return ['-fsanitize=' + ','.join(sanitizers), '-fno-omit-frame-pointer']
+    def linker_sanitizer_flags(self, sanitizers):
+        return ['-fsanitize=' + ','.join(sanitizers)]
+
+    def profile_generate_flags(self):
+        return ['-fprofile-instr-generate']
+    def profile_use_flags(self, profile):
+        return ['-fprofile-use=' + profile]
+    def profile_environment(self, raw):
+        return {'LLVM_PROFILE_FILE': path.join(raw, '%p.profraw')}
+    def raw_profile_extension(self):
+        return '.profraw'
+    def profile_merge_command(self, raw, output):
+        return ' '.join(['llvm-profdata', 'merge', '-output=' + output, path.join(raw, '*.profraw')])
+
+    def fast_debug_flags(self):
+        return ['-gsplit-dwarf']
+    def fast_debug_linker(self):
+        return 'lld'
+    def fast_debug_link_flags(self, ld):
+        return [] if ld in (None, 'bfd') else ['-Wl,--gdb-index']
+    def ld_flags(self, ld):
+        return ['-fuse-ld=' + ld]
+
+    def prefix_map_flags(self, prefix):
+        return ['-ffile-prefix-map=' + prefix + '=.']
+
+    def precompiled_header_name(self, header):
+        return header + '.pch'
+    def precompiled_header_flags(self, header, pch):
+        return ['-x', 'c++-header']
+    def use_precompiled_header_flags(self, header, pch):
+        return ['-include-pch', pch]
+    def force_include_flags(self, header):
+        return ['-include', header]
+    def precompiled_header_objects(self, pch):
         return []
 
+    def response_file(self, f):
+        return '@' + f
+
     def ninja_deps_style(self):
         return 'gcc'
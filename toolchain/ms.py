@@ -12,6 +12,7 @@
 # Microsoft toolchain
 
 import itertools
+from os import path
 
 class Toolchain:
     def compiler(self):
@@ -26,25 +27,39 @@ class Toolchain:
 
     def compiler_command(self,
                          command = 'g++',
+                         launcher = None,
                          dep_output = None,
                          debug = False,
-                         lto = True,
+                         fast_debug = False,
+                         lto = 'full',
+                         sanitizers = [],
+                         time_trace = False,
+                         profile_generate = False,
+                         profile_use = None,
                          warnings = [],
                          includes = [],
                          defines = [],
+                         prefix_map = None,
                          extraflags = '',
                          input = '',
                          output = ''):
         return ' '.join(itertools.chain(
+                    [launcher] if launcher else [],
                     [command],
                     ['/showIncludes'],
                     ['/nologo', '/c', '/TP', '/EHsc'],
-                    self.debug_flags() if debug else self.opt_flags(),
-                    self.compiler_lto_flags() if lto and not debug else [],
+                    (self.sanitizer_debug_flags() if sanitizers else self.debug_flags()) if debug else self.opt_flags(),
+                    self.fast_debug_flags() if debug and fast_debug else [],
+                    self.compiler_lto_flags(lto) if lto and not debug else [],
+                    self.sanitizer_flags(sanitizers) if sanitizers else [],
+                    self.time_trace_flags() if time_trace else [],
+                    self.profile_generate_flags() if profile_generate else [],
+                    self.profile_use_flags(profile_use) if profile_use else [],
                     warnings,
                     [self.include('include')],
                     (self.dep_include(i) for i in includes),
-                    (self.define(*kv) for kv in defines),
+                    (self.define(*kv) if isinstance(kv, tuple) else self.define(kv) for kv in defines),
+                    self.prefix_map_flags(prefix_map) if prefix_map else [],
                     [extraflags],
                     ['/Fo' + output],
                     [input]
@@ -55,7 +70,13 @@ class Toolchain:
                        libraries = [],
                        libpaths = [],
                        debug = False,
-                       lto = True,
+                       fast_debug = False,
+                       ld = None,
+                       lto = 'full',
+                       lto_jobs = None,
+                       lto_cache = None,
+                       sanitizers = [],
+                       profile_generate = False,
                        extraflags = '',
                        input = '',
                        output = ''):
@@ -63,7 +84,11 @@ class Toolchain:
                     [command],
                     ['/NOLOGO'],
                     (self.libpath(p) for p in libpaths),
-                    self.linker_lto_flags() if lto and not debug else [],
+                    self.linker_lto_flags(lto, lto_jobs, lto_cache) if lto and not debug else [],
+                    self.linker_sanitizer_flags(sanitizers) if sanitizers else [],
+                    self.profile_generate_flags() if profile_generate else [],
+                    self.ld_flags(ld) if ld else [],
+                    self.fast_debug_link_flags(ld) if debug and fast_debug else [],
                     [extraflags],
                     ['/OUT:' + output],
                     [input],
@@ -86,10 +111,19 @@ class Toolchain:
 
     def library_command(self,
                         command = linker,
+                        soname = None,
+                        implib = None,
                         extraflags = '',
-                        input = '',
-                        output = ''):
-        return 'foo'
+                        **kwargs):
+        return self.linker_command(
+                    command = command,
+                    extraflags = ' '.join(itertools.chain(
+                            ['/DLL'],
+                            ['/IMPLIB:' + implib] if implib else [],
+                            [extraflags]
+                        )),
+                    **kwargs
+                )
 
     def program_name(self, output):
         return output + '.exe'
@@ -97,6 +131,8 @@ class Toolchain:
         return output + '.lib'
     def library_name(self, output):
         return output + '.dll'
+    def import_library_name(self, output):
+        return output + '.dll.lib'
 
     def include(self, i):
         return '/I' + i;
@@ -111,12 +147,68 @@ class Toolchain:
 
     def debug_flags(self):
         return ['/MDd', '/ZI', '/Od', '/RTC1']
+    def sanitizer_debug_flags(self):
+        # /fsanitize=address does not work with edit and continue (/ZI) or runtime checks (/RTC1)
+        return ['/MDd', '/Zi', '/Od']
     def opt_flags(self):
         return ['/MD', '/O2', '/Oy-', '/Oi']
-    def compiler_lto_flags(self):
+    def compiler_lto_flags(self, lto):
         return ['/GL']
-    def linker_lto_flags(self):
-        return ['/LTCG']
+    def linker_lto_flags(self, lto, jobs=None, cache=None):
+        return ['/LTCG:INCREMENTAL' if lto == 'thin' else '/LTCG'] + (['/CGTHREADS:%d' % min(jobs, 8)] if jobs else [])
+    def lto_linker(self):
+        return None
+
+    def time_trace_flags(self):
+        return ['/Bt+']
+    def pic_flags(self):
+        return []
+    def runtime_path_flags(self):
+        return []
+
+    def supported_sanitizers(self):
+        return ['address']
+    def sanitizer_flags(self, sanitizers):
+        return ['/fsanitize=' + s for s in sanitizers]
+    def linker_sanitizer_flags(self, sanitizers):
+        return []
+
+    def profile_generate_flags(self):
+        return None
+    def profile_use_flags(self, profile):
+        return None
+    def profile_environment(self, raw):
+        return None
+    def raw_profile_extension(self):
+        return None
+    def profile_merge_command(self, raw, output):
+        return None
+
+    def fast_debug_flags(self):
+        return []
+    def fast_debug_linker(self):
+        return None
+    def fast_debug_link_flags(self, ld):
+        return ['/DEBUG:FASTLINK']
+    def ld_flags(self, ld):
+        return []
+
+    def prefix_map_flags(self, prefix):
+        return []
+
+    def precompiled_header_name(self, header):
+        return header + '.pch'
+    def precompiled_header_flags(self, header, pch):
+        return ['/Yc' + path.basename(header), '/FI' + path.basename(header), self.include(path.dirname(header) or '.'), '/Fp' + pch]
+    def use_precompiled_header_flags(self, header, pch):
+        return ['/Yu' + path.basename(header), '/FI' + path.basename(header), self.include(path.dirname(header) or '.'), '/Fp' + pch]
+    def force_include_flags(self, header):
+        return ['/FI' + header]
+    def precompiled_header_objects(self, pch):
+        return [pch + '.obj']
+
+    def response_file(self, f):
+        return '@' + f
 
     def ninja_deps_style(self):
         return 'msvc'
@@ -0,0 +1,143 @@
+# Vallus
+#
+# Written in 2015 by Martinho Fernandes <rmf@rmf.io>
+#
+# To the extent possible under law, the author(s) have dedicated all copyright and related
+# and neighboring rights to this software to the public domain worldwide. This software is
+# distributed without any warranty.
+#
+# You should have received a copy of the CC0 Public Domain Dedication along with this software.
+# If not, see <http://creativecommons.org/publicdomain/zero/1.0/>.
+#
+# Watch mode: rebootstrap when sources come and go, and rebuild when they change
+
+from os import path
+import ctypes
+import ctypes.util
+import json
+import os
+import select
+import struct
+import subprocess
+import sys
+import time
+
+_settle = 0.05 # seconds without events before acting on them
+_poll = 0.5 # seconds between scans when inotify is not available
+
+# inotify(7)
+_IN_ATTRIB = 0x4
+_IN_CLOSE_WRITE = 0x8
+_IN_MOVED_FROM = 0x40
+_IN_MOVED_TO = 0x80
+_IN_CREATE = 0x100
+_IN_DELETE = 0x200
+_IN_DELETE_SELF = 0x400
+_IN_ONLYDIR = 0x1000000
+_structural = _IN_CREATE | _IN_DELETE | _IN_MOVED_FROM | _IN_MOVED_TO | _IN_DELETE_SELF
+_event = struct.Struct('iIII')
+
+def _directories(cache):
+    # the source roots bootstrap scanned, with all their directories
+    try:
+        with open(cache) as f:
+            listings = json.load(f)
+    except (OSError, ValueError):
+        return []
+    return sorted(d for root in listings.values() for d in root)
+
+class _Inotify:
+    def __init__(self):
+        self._libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+        self._fd = self._libc.inotify_init1(os.O_CLOEXEC)
+        if self._fd < 0:
+            raise OSError(ctypes.get_errno(), 'inotify_init1 failed')
+        self._watches = {}
+
+    def watch(self, directories):
+        watched = set(self._watches.values())
+        for d in directories:
+            if d in watched:
+                continue
+            mask = _structural | _IN_CLOSE_WRITE | _IN_ATTRIB | _IN_ONLYDIR
+            wd = self._libc.inotify_add_watch(self._fd, os.fsencode(d), mask)
+            if wd >= 0:
+                self._watches[wd] = d
+
+    def wait(self):
+        """Blocks until something changes, and returns whether files or folders came or went."""
+        structural = False
+        timeout = None
+        while select.select([self._fd], [], [], timeout)[0]:
+            data = os.read(self._fd, 65536)
+            offset = 0
+            while offset < len(data):
+                wd, mask, _, length = _event.unpack_from(data, offset)
+                offset += _event.size + length
+                structural = structural or bool(mask & _structural)
+                if mask & _IN_DELETE_SELF:
+                    self._watches.pop(wd, None)
+            timeout = _settle
+        return structural
+
+class _Poller:
+    def __init__(self):
+        self._directories = []
+        self._state = None
+
+    def watch(self, directories):
+        self._directories = directories
+        self._state = self._snapshot()
+
+    def _snapshot(self):
+        state = {}
+        for d in self._directories:
+            try:
+                entries = list(os.scandir(d))
+            except OSError:
+                continue
+            for entry in entries:
+                try:
+                    state[entry.path] = entry.stat().st_mtime_ns if entry.is_file() else None
+                except OSError:
+                    pass
+        return state
+
+    def wait(self):
+        """Blocks until something changes, and returns whether files or folders came or went."""
+        while True:
+            time.sleep(_poll)
+            state = self._snapshot()
+            if state != self._state:
+                structural = state.keys() != self._state.keys()
+                self._state = state
+                return structural
+
+def _bootstrap_command(ninja):
+    # the bootstrap edge has no inputs to build, so this is its command alone
+    output = subprocess.check_output([ninja, '-t', 'commands', 'build.ninja'])
+    return output.decode('utf-8').strip().splitlines()[-1]
+
+def watch(args):
+    cache = path.join('obj', 'files.json')
+    if not path.isfile('build.ninja') or not path.isfile(cache):
+        sys.exit('vallus watch: run the bootstrap script first')
+    bootstrap = _bootstrap_command(args.ninja)
+    try:
+        watcher = _Inotify()
+    except (OSError, AttributeError):
+        watcher = _Poller()
+    watcher.watch(_directories(cache))
+    ninja = [args.ninja] + args.command
+    subprocess.call(ninja)
+    try:
+        while True:
+            if watcher.wait():
+                # the scan cache only relists folders that changed, and unchanged
+                # manifest files are left alone, so this stays cheap
+                if subprocess.call(bootstrap, shell=True) != 0:
+                    continue
+                watcher.watch(_directories(cache))
+            subprocess.call(ninja)
+    except KeyboardInterrupt:
+        pass